@@ -1,14 +1,31 @@
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
 from werkzeug.datastructures import FileStorage
+from werkzeug.wsgi import get_input_stream
 from flask_restx import Resource, Api, fields
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from flask_sqlalchemy import SQLAlchemy
 from dateutil.parser import isoparse
 from flask_migrate import Migrate
 from flask import Flask, request
 from dotenv import load_dotenv
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+from array import array
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from itertools import repeat
 from pathlib import Path
+import zstandard
+import multiprocessing
+import threading
 import logging
+import hashlib
 import pymysql
+import gzip
+import zlib
+import math
 import json
+import io
 
 import os
 # configure root logger
@@ -33,6 +50,39 @@ MYSQL_URL = os.getenv('MYSQL_URL')
 PROVIDER_FILE_PATH = Path('../data/providers.json')
 SPOTPRICES_FILE_PATH = Path('../data/spotpriser.json')
 
+# UPLOADS
+# Rows per INSERT statement when ingesting columnar consumption uploads.
+CONSUMPTION_INSERT_BATCH_SIZE = 5000
+# Magic bytes used to recognise compressed files regardless of their name.
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+# Wall clock time zone of stored consumption and of spotpriser.json.
+LOCAL_TIMEZONE = ZoneInfo('Europe/Oslo')
+# Largest size in bytes a compressed upload may expand to.
+MAX_DECOMPRESSED_UPLOAD_SIZE = int(
+    os.getenv('MAX_DECOMPRESSED_UPLOAD_SIZE', 256 * 1024 * 1024))
+
+# PRICING
+PRICE_ZONES = ('NO1', 'NO2', 'NO3', 'NO4', 'NO5')
+# Providers are priced in parallel by a pool of PRICING_WORKERS, either
+# 'process' or 'thread' workers. Below PRICING_PARALLEL_THRESHOLD
+# (providers x consumption rows) the serial path is used, since handing the
+# work to the pool costs more than it saves.
+PRICING_WORKERS = int(os.getenv('PRICING_WORKERS', os.cpu_count() or 1))
+PRICING_POOL = os.getenv('PRICING_POOL', 'process')
+PRICING_PARALLEL_THRESHOLD = int(
+    os.getenv('PRICING_PARALLEL_THRESHOLD', 200000))
+
+# SNAPSHOTS
+# Seconds between background checks for stale recommendation snapshots,
+# 0 turns the background refresher off.
+SNAPSHOT_REFRESH_INTERVAL = int(os.getenv('SNAPSHOT_REFRESH_INTERVAL', 60))
+# A customer's last activity is only written when it is older than this,
+# so answering from a snapshot does not need a write every time.
+CUSTOMER_ACTIVITY_RESOLUTION = timedelta(minutes=5)
+# Number of locks customers are spread over when computing snapshots.
+SNAPSHOT_LOCK_STRIPES = 64
+
 # create the app
 app = Flask(__name__)
 # create the extension
@@ -49,6 +99,10 @@ db.init_app(app)
 class Customer(db.Model):
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     username = db.Column(db.String(100), unique=True, nullable=False)
+    last_active_datetime = db.Column(db.DateTime)
+    # Bumped together with every change to the customer's consumption.
+    consumption_version = db.Column(
+        db.Integer, nullable=False, default=0, server_default='0')
     consumptions = db.relationship(
         'Consumption', backref='customer', lazy=True)
 
@@ -74,6 +128,22 @@ class Provider(db.Model):
     variable_price_period = db.Column(db.Integer)
     spot_price = db.Column(db.Float)
 
+
+# Last computed best option and cost matrix for a customer, along with the
+# versions of the spot prices, providers and consumption it was computed
+# from. When the calculation failed, error is set instead of payload, so it
+# is not retried until one of the versions changes.
+class RecommendationSnapshot(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey(
+        'customer.id'), unique=True, nullable=False)
+    spot_version = db.Column(db.String(64), nullable=False)
+    provider_version = db.Column(db.String(64), nullable=False)
+    consumption_version = db.Column(db.Integer, nullable=False)
+    payload = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    computed_datetime = db.Column(db.DateTime, nullable=False)
+
 # Handler functions
 
 
@@ -112,6 +182,18 @@ class CustomerHandler:
         customer = self.db.session.query(Customer).get(customer_id)
         return customer.consumptions
 
+    def get_consumption_version(self, customer_id):
+        return self.db.session.query(Customer.consumption_version).filter_by(id=customer_id).scalar()
+
+    def touch_customer(self, customer_id):
+        customer = self.db.session.query(Customer).get(customer_id)
+        now = datetime.utcnow()
+        if customer.last_active_datetime is None or \
+                now - customer.last_active_datetime >= CUSTOMER_ACTIVITY_RESOLUTION:
+            customer.last_active_datetime = now
+            self.db.session.commit()
+        return customer
+
 
 class ConsumptionHandler:
     def __init__(self, db):
@@ -126,13 +208,14 @@ class ConsumptionHandler:
             customer_id=customer_id
         )
         self.db.session.add(consumption)
+        self.bump_consumption_version(customer_id)
         self.db.session.commit()
         return consumption
 
     def create_bulk_consumption(self, data, customer_id, remove_old=True):
         # We want to remove old consumption when uploading in bulk.
         if remove_old:
-            self.delete_all_consumptions_for_user(customer_id)
+            self.delete_all_consumptions_for_user(customer_id, commit=False)
 
         consumptions = []
         for item in data:
@@ -145,9 +228,48 @@ class ConsumptionHandler:
             ))
 
         self.db.session.bulk_save_objects(consumptions)
+        self.bump_consumption_version(customer_id)
         self.db.session.commit()
         return consumptions
 
+    def create_columnar_consumption(self, start, interval, values, consumption_unit, customer_id, remove_old=True):
+        # Same as create_bulk_consumption, but for the compact columnar format.
+        # The start timestamp is parsed once and every following row is
+        # derived from it, so we skip the ORM and the per-row isoparse, and
+        # insert the rows in batches straight through the table.
+        # Rows are stepped in UTC and converted to local time, the wall clock
+        # times the row format and spotpriser.json use, so they stay in line
+        # with the spot prices across daylight saving time changes.
+        # The delete and the inserts are committed together, so a failed
+        # upload leaves the old consumption in place.
+        if remove_old:
+            self.delete_all_consumptions_for_user(customer_id, commit=False)
+
+        start_utc = isoparse(start).astimezone(timezone.utc)
+        step = timedelta(seconds=interval)
+        insert_q = Consumption.__table__.insert()
+
+        rows = []
+        for index, value in enumerate(values):
+            from_utc = start_utc + index * step
+            rows.append({
+                'from_datetime': from_utc.astimezone(LOCAL_TIMEZONE),
+                'to_datetime': (from_utc + step).astimezone(LOCAL_TIMEZONE),
+                'consumption': float(value),
+                'consumption_unit': consumption_unit,
+                'customer_id': customer_id
+            })
+
+            if len(rows) >= CONSUMPTION_INSERT_BATCH_SIZE:
+                self.db.session.execute(insert_q, rows)
+                rows = []
+
+        if rows:
+            self.db.session.execute(insert_q, rows)
+        self.bump_consumption_version(customer_id)
+        self.db.session.commit()
+        return len(values)
+
     def get_consumption_by_id(self, consumption_id):
         return self.db.session.query(Consumption).get(consumption_id)
 
@@ -157,22 +279,34 @@ class ConsumptionHandler:
         consumption.to_datetime = isoparse(to_datetime)
         consumption.consumption = consumption
         consumption.consumption_unit = consumption_unit
+        self.bump_consumption_version(consumption.customer_id)
         self.db.session.commit()
         return consumption
 
     def delete_consumption(self, consumption_id):
         consumption = self.db.session.query(Consumption).get(consumption_id)
         self.db.session.delete(consumption)
+        self.bump_consumption_version(consumption.customer_id)
         self.db.session.commit()
         return consumption
 
     # We take abit of a different approach since we are bulk deleting,
     # credit to https://stackoverflow.com/questions/39773560/sqlalchemy-how-do-you-delete-multiple-rows-without-querying
-    def delete_all_consumptions_for_user(self, customer_id):
+    def delete_all_consumptions_for_user(self, customer_id, commit=True):
         delete_q = Consumption.__table__.delete().where(
             Consumption.customer_id == customer_id)
         self.db.session.execute(delete_q)
-        self.db.session.commit()
+        self.bump_consumption_version(customer_id)
+        if commit:
+            self.db.session.commit()
+
+    # Done in the same transaction as the change to the consumption, so a
+    # snapshot can never carry a version its consumption did not have.
+    def bump_consumption_version(self, customer_id):
+        update_q = Customer.__table__.update().where(
+            Customer.id == customer_id).values(
+            consumption_version=Customer.consumption_version + 1)
+        self.db.session.execute(update_q)
 
     def get_customer_consumptions(self, customer_id):
         return self.db.session.query(Consumption).filter_by(customer_id=customer_id).all()
@@ -250,7 +384,52 @@ class ProviderHandler:
         return providers
 
     def get_all_providers(self):
-        return self.db.session.query(Provider).all()
+        return self.db.session.query(Provider).order_by(Provider.id).all()
+
+
+class SnapshotHandler:
+    def __init__(self, db):
+        self.db = db
+
+    def get_snapshot(self, customer_id):
+        return self.db.session.query(RecommendationSnapshot).filter_by(customer_id=customer_id).first()
+
+    # An upsert (INSERT ... ON DUPLICATE KEY UPDATE), since a request and the
+    # refresher, possibly in other processes, can save the same customer.
+    def save_snapshot(self, customer_id, spot_version, provider_version, consumption_version, payload, error=None):
+        insert_q = mysql_insert(RecommendationSnapshot.__table__).values(
+            customer_id=customer_id,
+            spot_version=spot_version,
+            provider_version=provider_version,
+            consumption_version=consumption_version,
+            payload=payload,
+            error=error,
+            computed_datetime=datetime.utcnow()
+        )
+        insert_q = insert_q.on_duplicate_key_update(
+            spot_version=insert_q.inserted.spot_version,
+            provider_version=insert_q.inserted.provider_version,
+            consumption_version=insert_q.inserted.consumption_version,
+            payload=insert_q.inserted.payload,
+            error=insert_q.inserted.error,
+            computed_datetime=insert_q.inserted.computed_datetime
+        )
+        self.db.session.execute(insert_q)
+        self.db.session.commit()
+
+    def get_customer_ids_with_stale_snapshot(self, spot_version, provider_version):
+        # Customers without a snapshot, or with one computed from other
+        # versions, most recently active first.
+        rows = self.db.session.query(Customer.id).outerjoin(
+            RecommendationSnapshot,
+            RecommendationSnapshot.customer_id == Customer.id
+        ).filter(self.db.or_(
+            RecommendationSnapshot.id.is_(None),
+            RecommendationSnapshot.spot_version != spot_version,
+            RecommendationSnapshot.provider_version != provider_version,
+            RecommendationSnapshot.consumption_version != Customer.consumption_version
+        )).order_by(Customer.last_active_datetime.desc()).all()
+        return [row.id for row in rows]
 
 
 # Migrations
@@ -260,6 +439,7 @@ migrate = Migrate(app, db)
 CH = CustomerHandler(db)
 CSH = ConsumptionHandler(db)
 PH = ProviderHandler(db)
+SH = SnapshotHandler(db)
 
 api = Api(app, version='1.0', title='Sample API',
           description='A sample API',
@@ -271,10 +451,214 @@ upload_parser.add_argument('file', location='files',
                            type=FileStorage, required=True)
 upload_parser.add_argument('name', type=str, location='form')
 
+
+class CappedStream(io.RawIOBase):
+    # Reads from a decompressing stream. Raises 413 once more than max_size
+    # bytes have been read, so a small compressed body can not expand without
+    # bound, and 400 when the compressed data is corrupt or truncated. The
+    # latter also covers request bodies, which are decompressed while the
+    # form is parsed.
+    def __init__(self, stream, max_size):
+        self.stream = stream
+        self.max_size = max_size
+        self.size = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self.stream.read(len(buffer))
+        except (OSError, EOFError, zlib.error, zstandard.ZstdError):
+            raise BadRequest("Could not decompress the upload")
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise RequestEntityTooLarge()
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def open_decompressed_stream(stream, encoding):
+    # Wraps a file-like object so it is decompressed as it is read,
+    # instead of inflating the whole payload into memory up front.
+    if encoding == 'gzip':
+        decompressed = gzip.GzipFile(fileobj=stream, mode='rb')
+    elif encoding == 'zstd':
+        # pzstd and concatenated uploads consist of several frames.
+        decompressed = zstandard.ZstdDecompressor().stream_reader(
+            stream, read_across_frames=True)
+    else:
+        return stream
+    return CappedStream(decompressed, MAX_DECOMPRESSED_UPLOAD_SIZE)
+
+
+# Clients may compress the whole request body and mark it with the
+# Content-Encoding header. Werkzeug does not decode request bodies, so we
+# swap the WSGI input stream before the form/files are parsed. The raw input
+# is first limited to the Content-Length, otherwise the decompressor would
+# keep reading from the socket of a keep-alive connection. The decompressed
+# length is unknown, so the new stream is marked as terminated.
+@app.before_request
+def decompress_request_body():
+    encoding = request.headers.get('Content-Encoding', '').strip().lower()
+    if encoding not in ('gzip', 'zstd'):
+        return None
+    environ = request.environ
+    environ['wsgi.input'] = open_decompressed_stream(
+        get_input_stream(environ), encoding)
+    environ['wsgi.input_terminated'] = True
+    environ.pop('CONTENT_LENGTH', None)
+    environ.pop('HTTP_CONTENT_ENCODING', None)
+    return None
+
+
+# Pricing functions, these live outside of HelperMethods so that they can
+# be sent to worker processes. A provider is a plain dict here (see
+# HelperMethods.provider_to_pricing_dict), and columns holds the consumption
+# and price series built by HelperMethods.build_pricing_columns.
+def price_provider(provider, columns):
+    consumption = columns['consumption']
+
+    if provider['pricing_model'] == 'variable':
+        # when variable, we persume the spot price is already accounted in,
+        # and only look to take the consumed kwh times the price.
+        use = 0.00
+        for value in consumption:
+            use += value * provider['variable_price']
+
+        return {
+            "name": provider['name'],
+            "pricingModel": "variable",
+            "variablePrice": provider['variable_price'],
+            "cost_based_on_user_history": {zone: use for zone in PRICE_ZONES},
+        }
+
+    elif provider['pricing_model'] == 'fixed':
+        # when fixed, we persume the spot price is already accounted in,
+        # and only look to take the comsued kwh times the price.
+        use = 0.00
+        for value in consumption:
+            use += value * provider['fixed_price']
+
+        return {
+            "name": provider['name'],
+            "pricingModel": "fixed",
+            "fixedPrice": provider['fixed_price'],
+            "cost_based_on_user_history": {zone: use for zone in PRICE_ZONES},
+        }
+
+    elif provider['pricing_model'] in ('spot-hourly', 'spot-monthly'):
+        # when spot-hourly, we calculate each hour as independent,
+        # when spot-monthly, we persume average monthly spot price.
+        if provider['pricing_model'] == 'spot-hourly':
+            prices = columns['hourly']
+        else:
+            prices = columns['monthly']
+
+        cost = {}
+        for zone in PRICE_ZONES:
+            use = 0.00
+            for value, price in zip(consumption, prices[zone]):
+                use += value * (provider['spot_price'] + price)
+            cost[zone] = use
+
+        return {
+            "name": provider['name'],
+            "pricingModel": provider['pricing_model'],
+            "fixedPrice": provider['spot_price'],
+            "cost_based_on_user_history": cost,
+        }
+
+    return None
+
+
+def share_pricing_columns(columns):
+    # Copies the columns into one shared memory block, series after series.
+    # Tasks only carry the block name and the layout, so the series are not
+    # pickled for every task. The caller closes and unlinks the block.
+    layout = [('consumption', None)]
+    for key in ('hourly', 'monthly'):
+        if key in columns:
+            layout.extend((key, zone) for zone in PRICE_ZONES)
+
+    n = len(columns['consumption'])
+    block = shared_memory.SharedMemory(
+        create=True, size=max(1, len(layout) * n * 8))
+    view = block.buf.cast('d')
+    try:
+        for index, (key, zone) in enumerate(layout):
+            series = columns[key] if zone is None else columns[key][zone]
+            view[index * n:(index + 1) * n] = array('d', series)
+    except Exception:
+        view.release()
+        block.close()
+        block.unlink()
+        raise
+    view.release()
+    return block, layout
+
+
+# Series each pricing model reads besides the consumption.
+PRICING_MODEL_SERIES = {'spot-hourly': 'hourly', 'spot-monthly': 'monthly'}
+
+
+def _price_provider_in_worker(provider, block_name, layout, n):
+    # Only the series the provider's pricing model needs are read, and they
+    # are iterated straight from the shared block without copying.
+    needed = {'consumption', PRICING_MODEL_SERIES.get(provider['pricing_model'])}
+    block = shared_memory.SharedMemory(name=block_name)
+    view = block.buf.cast('d')
+    slices = []
+    try:
+        columns = {}
+        for index, (key, zone) in enumerate(layout):
+            if key not in needed:
+                continue
+            series = view[index * n:(index + 1) * n]
+            slices.append(series)
+            if zone is None:
+                columns[key] = series
+            else:
+                columns.setdefault(key, {})[zone] = series
+        return price_provider(provider, columns)
+    finally:
+        # All views have to be released before the block can be closed.
+        for series in slices:
+            series.release()
+        view.release()
+        block.close()
+
+
+# One pool for the lifetime of the process. Worker processes are started
+# through a forkserver (spawn where that is missing), never forked from the
+# threaded server, where they could inherit locks held by other threads.
+_pricing_pool = None
+_pricing_pool_lock = threading.Lock()
+
+
+def get_pricing_pool():
+    global _pricing_pool
+    with _pricing_pool_lock:
+        if _pricing_pool is None:
+            if PRICING_POOL == 'thread':
+                _pricing_pool = ThreadPoolExecutor(
+                    max_workers=PRICING_WORKERS)
+            else:
+                if 'forkserver' in multiprocessing.get_all_start_methods():
+                    context = multiprocessing.get_context('forkserver')
+                else:
+                    context = multiprocessing.get_context('spawn')
+                _pricing_pool = ProcessPoolExecutor(
+                    max_workers=PRICING_WORKERS, mp_context=context)
+        return _pricing_pool
+
+
 # Helper functinos, Initualized in this document as HelperMethods
 class HelperMethods:
     def __init__(self):
-        pass
+        self.spot_data = None
+        self.snapshot_locks = [threading.Lock()
+                               for _ in range(SNAPSHOT_LOCK_STRIPES)]
 
     def get_spot_prices(self, file_path):
         with open(file_path, 'r') as file:
@@ -282,21 +666,216 @@ class HelperMethods:
             file.close()
         return json_data
 
+    def get_spot_data(self, file_path):
+        # Spot prices are only re-read and re-averaged when the file changes
+        # on disk, the version is a hash of the file content.
+        stat = os.stat(file_path)
+        stat_key = (stat.st_mtime_ns, stat.st_size)
+        spot_data = self.spot_data
+        if spot_data is None or spot_data['stat_key'] != stat_key:
+            with open(file_path, 'rb') as file:
+                content = file.read()
+            spotprices = json.loads(content)
+            spot_data = {
+                'stat_key': stat_key,
+                'version': hashlib.sha256(content).hexdigest(),
+                'spotprices': spotprices,
+                'monthly_average_spot_price': self.get_monthly_average_spot_price(spotprices),
+            }
+            self.spot_data = spot_data
+        return spot_data
+
+    def get_provider_version(self, provider_dicts):
+        return hashlib.sha256(json.dumps(provider_dicts).encode()).hexdigest()
+
+    def open_uploaded_file(self, uploaded_file):
+        # The uploaded file itself may be gzip or zstd compressed
+        # (e.g. consumption.json.gz), we look at the first bytes to find out.
+        stream = uploaded_file.stream
+        magic = stream.read(len(ZSTD_MAGIC))
+        stream.seek(0)
+        if magic.startswith(GZIP_MAGIC):
+            return open_decompressed_stream(stream, 'gzip')
+        if magic.startswith(ZSTD_MAGIC):
+            return open_decompressed_stream(stream, 'zstd')
+        return stream
+
+    def is_number(self, value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) \
+            and math.isfinite(value)
+
+    def validate_columnar_consumption(self, data):
+        # Checked before anything is written, so bad input does not leave the
+        # customer without the consumption they had.
+        start = data.get('start')
+        try:
+            start = isoparse(start) if isinstance(start, str) else None
+        except ValueError:
+            start = None
+        if start is None or start.tzinfo is None:
+            api.abort(400, "'start' must be an ISO 8601 timestamp with a UTC offset")
+        interval = data.get('interval')
+        if not self.is_number(interval) or interval < 1:
+            api.abort(400, "'interval' must be a number of seconds, at least 1")
+        values = data.get('consumption')
+        if not isinstance(values, list) or not all(self.is_number(value) for value in values):
+            api.abort(400, "'consumption' must be a list of numbers")
+        try:
+            # The last row has to end on a date we can represent.
+            end = start.astimezone(timezone.utc) + \
+                len(values) * timedelta(seconds=interval)
+            end.astimezone(LOCAL_TIMEZONE)
+        except OverflowError:
+            api.abort(400, "'consumption' runs past the latest supported date")
+        consumption_unit = data.get('consumptionUnit', 'kWh')
+        max_length = Consumption.__table__.c.consumption_unit.type.length
+        if not isinstance(consumption_unit, str) or len(consumption_unit) > max_length:
+            api.abort(400, f"'consumptionUnit' must be a string of at most {max_length} characters")
+
     def ingest_json_to_customer(self, username, uploaded_file):
+        try:
+            data = json.load(self.open_uploaded_file(uploaded_file))
+        except (ValueError, OSError, EOFError, zstandard.ZstdError):
+            api.abort(400, "'file' must be JSON, optionally gzip or zstd compressed")
+
+        # Columnar format:
+        # {"start": "2022-12-17T20:00:00.000+01:00", "interval": 3600,
+        #  "consumptionUnit": "kWh", "consumption": [8.741, 8.281, ...]}
+        if isinstance(data, dict):
+            self.validate_columnar_consumption(data)
+
         # get or create customer
         customer = CH.get_or_create_customer(username)
-        data = json.load(uploaded_file.stream)
-        CSH.create_bulk_consumption(data=data, customer_id=customer.id)
+        if isinstance(data, dict):
+            CSH.create_columnar_consumption(
+                start=data['start'],
+                interval=data['interval'],
+                values=data['consumption'],
+                consumption_unit=data.get('consumptionUnit', 'kWh'),
+                customer_id=customer.id)
+        else:
+            CSH.create_bulk_consumption(data=data, customer_id=customer.id)
+
+        # The consumption version was bumped, so the snapshot is stale now,
+        # let the refresher pick the customer up.
+        CH.touch_customer(customer.id)
+        SR.notify()
         return "Accepted"
 
-    def calculate_best_options_for_user(self, username):
-        # Get neccesary data
+    def get_best_options_for_user(self, username):
+        # Serves the snapshot when it was computed from the current spot
+        # prices, providers and consumption, otherwise calculates and stores
+        # a new one.
         customer = CH.get_customer_by_username(username=username)
-        providers = PH.get_all_providers()
-        spotprices = self.get_spot_prices(SPOTPRICES_FILE_PATH)
+        CH.touch_customer(customer.id)
+        provider_dicts = [self.provider_to_pricing_dict(provider)
+                          for provider in PH.get_all_providers()]
+        spot_data = self.get_spot_data(SPOTPRICES_FILE_PATH)
+        provider_version = self.get_provider_version(provider_dicts)
+        best_options, error = self.refresh_snapshot(
+            customer.id, provider_dicts, spot_data, provider_version)
+        if error is not None:
+            api.abort(422, f"Could not calculate recommendations: {error}")
+        return best_options
+
+    def get_snapshot_lock(self, customer_id):
+        # A fixed set of locks shared by id, so there is no lock per customer
+        # to keep around. Two customers sharing a lock only wait on each other.
+        return self.snapshot_locks[customer_id % len(self.snapshot_locks)]
+
+    def refresh_snapshot(self, customer_id, provider_dicts, spot_data, provider_version):
+        # Both the calculate endpoint and the refresher go through here. The
+        # snapshot is read again while holding the customer's lock, so when
+        # both want the same customer the second one serves what the first
+        # one computed, instead of computing it again.
+        # Returns the best options and an error, one of them is None.
+        with self.get_snapshot_lock(customer_id):
+            # End the current transaction, so a snapshot committed while we
+            # waited for the lock is visible. The consumption version is read
+            # first, the consumption later in the same (repeatable read)
+            # transaction, so it is exactly the version the rows belong to.
+            db.session.rollback()
+            consumption_version = CH.get_consumption_version(customer_id)
+            snapshot = SH.get_snapshot(customer_id)
+            if snapshot is not None \
+                    and snapshot.spot_version == spot_data['version'] \
+                    and snapshot.provider_version == provider_version \
+                    and snapshot.consumption_version == consumption_version:
+                return snapshot.payload, snapshot.error
+
+            try:
+                best_options = self.calculate_best_options_for_customer(
+                    customer_id, provider_dicts, spot_data['spotprices'],
+                    spot_data['monthly_average_spot_price'])
+            except (KeyError, ValueError, TypeError) as e:
+                # The calculation itself failed, e.g. consumption outside of
+                # the range of spotpriser.json (KeyError), a month without
+                # spot prices (TypeError) or no providers (ValueError). This
+                # will fail again with the same data, so it is recorded
+                # against the current versions and only tried again once
+                # something has changed. Database errors are not caught here,
+                # they are retried on the next request or refresh.
+                db.session.rollback()
+                logging.exception(
+                    f"Calculating snapshot for customer {customer_id} failed")
+                error = f"{type(e).__name__}: {e}"
+                SH.save_snapshot(customer_id, spot_data['version'],
+                                 provider_version, consumption_version,
+                                 None, error=error)
+                return None, error
+
+            SH.save_snapshot(customer_id, spot_data['version'],
+                             provider_version, consumption_version,
+                             best_options)
+            return best_options, None
+
+    def refresh_snapshots(self):
+        # Recomputes every stale snapshot in one go, loading the spot prices
+        # and providers once for all customers. Providers are turned into
+        # plain dicts and customers passed by id, refresh_snapshot ends the
+        # transaction for every customer, which would expire ORM instances.
+        provider_dicts = [self.provider_to_pricing_dict(provider)
+                          for provider in PH.get_all_providers()]
+        if not provider_dicts:
+            return 0
+        spot_data = self.get_spot_data(SPOTPRICES_FILE_PATH)
+        provider_version = self.get_provider_version(provider_dicts)
+
+        customer_ids = SH.get_customer_ids_with_stale_snapshot(
+            spot_data['version'], provider_version)
+        for customer_id in customer_ids:
+            # Failed calculations are recorded by refresh_snapshot, this only
+            # keeps e.g. a database error from holding back the rest.
+            try:
+                self.refresh_snapshot(
+                    customer_id, provider_dicts, spot_data, provider_version)
+            except Exception:
+                db.session.rollback()
+                logging.exception(
+                    f"Refreshing snapshot for customer {customer_id} failed")
+        if customer_ids:
+            logging.info(f"Refreshed {len(customer_ids)} recommendation snapshots")
+        return len(customer_ids)
+
+    def calculate_best_options_for_customer(self, customer_id, provider_dicts, spotprices, monthly_average_spot_price):
         consumption_data = CSH.get_customer_consumptions(
-            customer_id=customer.id)
+            customer_id=customer_id)
+
+        # Return payload, one entry per provider, in provider order.
+        columns = self.build_pricing_columns(
+            consumption_data, spotprices, monthly_average_spot_price,
+            pricing_models={provider['pricing_model'] for provider in provider_dicts})
+        payload = self.price_providers(provider_dicts, columns)
+
+        # Find the entry with the lowest NO1 value - Curtesy of ChatGPT
+        lowest_no1_entry = min(
+            payload, key=lambda x: x["cost_based_on_user_history"]["NO1"])
+
+        payload.remove(lowest_no1_entry)
+
+        return {"best_option": lowest_no1_entry, "other_options": payload}
 
+    def get_monthly_average_spot_price(self, spotprices):
         # first we locate the independent monthly averages
         # this could have been done through datetime manipulation, but for
         # the sace of simplicity i will simply do so using dicts and string
@@ -333,135 +912,71 @@ class HelperMethods:
                     "n": 1
                 }
 
-        # Return payload:
-        payload = []
-        # Calculate cost
-        for provider in providers:
-            if provider.pricing_model == 'variable':
-                # when variable, we persume the spot price is already accounted in,
-                # and only look to take the consumed kwh times the price.
-                use = 0.00
-                for consumption in consumption_data:
-                    use += consumption.consumption * provider.variable_price
-
-                payload.append({
-                    "name": provider.name,
-                    "pricingModel": "variable",
-                    "variablePrice": provider.variable_price,
-                    "cost_based_on_user_history": {
-                        "NO1": use,
-                        "NO2": use,
-                        "NO3": use,
-                        "NO4": use,
-                        "NO5": use
-                    },
-                })
-
-            elif provider.pricing_model == 'fixed':
-                # when fixed, we persume the spot price is already accounted in,
-                # and only look to take the comsued kwh times the price.
-                use = 0.00
-                for consumption in consumption_data:
-                    use += consumption.consumption * provider.fixed_price
-
-                payload.append({
-                    "name": provider.name,
-                    "pricingModel": "fixed",
-                    "fixedPrice": provider.fixed_price,
-                    "cost_based_on_user_history": {
-                        "NO1": use,
-                        "NO2": use,
-                        "NO3": use,
-                        "NO4": use,
-                        "NO5": use
-                    },
-                })
-
-            elif provider.pricing_model == 'spot-hourly':
-                # when spot-hourly, we calculate each hour as independent.
-                use_no1 = 0.00
-                use_no2 = 0.00
-                use_no3 = 0.00
-                use_no4 = 0.00
-                use_no5 = 0.00
-                for consumption in consumption_data:
-
-                    time_key = (consumption.from_datetime).isoformat()
-
-                    use_no1 += consumption.consumption * \
-                        (provider.spot_price + spotprices[time_key]["NO1"])
-                    use_no2 += consumption.consumption * \
-                        (provider.spot_price + spotprices[time_key]["NO2"])
-                    use_no3 += consumption.consumption * \
-                        (provider.spot_price + spotprices[time_key]["NO3"])
-                    use_no4 += consumption.consumption * \
-                        (provider.spot_price + spotprices[time_key]["NO4"])
-                    use_no5 += consumption.consumption * \
-                        (provider.spot_price + spotprices[time_key]["NO5"])
-
-                payload.append({
-                    "name": provider.name,
-                    "pricingModel": "spot-hourly",
-                    "fixedPrice": provider.spot_price,
-                    "cost_based_on_user_history": {
-                        "NO1": use_no1,
-                        "NO2": use_no2,
-                        "NO3": use_no3,
-                        "NO4": use_no4,
-                        "NO5": use_no5
-                    },
-                })
-
-            elif provider.pricing_model == 'spot-monthly':
-                # when spot-monthly, we persume average monthly spot price
-                use_no1 = 0.00
-                use_no2 = 0.00
-                use_no3 = 0.00
-                use_no4 = 0.00
-                use_no5 = 0.00
-                for consumption in consumption_data:
-
-                    relevant_month = monthly_average_spot_price.get(
-                        consumption.from_datetime.strftime('%m'), 0)
-
-                    relevant_month_n = relevant_month['n']
-
-                    use_no1 += consumption.consumption * \
-                        (provider.spot_price +
-                         (relevant_month['NO1']/relevant_month_n))
-                    use_no2 += consumption.consumption * \
-                        (provider.spot_price +
-                         (relevant_month['NO2']/relevant_month_n))
-                    use_no3 += consumption.consumption * \
-                        (provider.spot_price +
-                         (relevant_month['NO3']/relevant_month_n))
-                    use_no4 += consumption.consumption * \
-                        (provider.spot_price +
-                         (relevant_month['NO4']/relevant_month_n))
-                    use_no5 += consumption.consumption * \
-                        (provider.spot_price +
-                         (relevant_month['NO5']/relevant_month_n))
-
-                payload.append({
-                    "name": provider.name,
-                    "pricingModel": "spot-monthly",
-                    "fixedPrice": provider.spot_price,
-                    "cost_based_on_user_history": {
-                        "NO1": use_no1,
-                        "NO2": use_no2,
-                        "NO3": use_no3,
-                        "NO4": use_no4,
-                        "NO5": use_no5
-                    },
-                })
-
-        # Find the entry with the lowest NO1 value - Curtesy of ChatGPT
-        lowest_no1_entry = min(
-            payload, key=lambda x: x["cost_based_on_user_history"]["NO1"])
-
-        payload.remove(lowest_no1_entry)
-
-        return {"best_option": lowest_no1_entry, "other_options": payload}
+        return monthly_average_spot_price
+
+    def provider_to_pricing_dict(self, provider):
+        return {
+            "name": provider.name,
+            "pricing_model": provider.pricing_model,
+            "fixed_price": provider.fixed_price,
+            "variable_price": provider.variable_price,
+            "spot_price": provider.spot_price,
+        }
+
+    def build_pricing_columns(self, consumption_data, spotprices, monthly_average_spot_price, pricing_models):
+        # Lines the consumption up with the spot price of the same hour and
+        # the average spot price of the same month, one list per zone. Only
+        # the price series needed by the given pricing models are built.
+        columns = {'consumption': [
+            consumption.consumption for consumption in consumption_data]}
+
+        if 'spot-hourly' in pricing_models:
+            hourly = {zone: [] for zone in PRICE_ZONES}
+            for consumption in consumption_data:
+                time_key = (consumption.from_datetime).isoformat()
+                for zone in PRICE_ZONES:
+                    hourly[zone].append(spotprices[time_key][zone])
+            columns['hourly'] = hourly
+
+        if 'spot-monthly' in pricing_models:
+            monthly = {zone: [] for zone in PRICE_ZONES}
+            for consumption in consumption_data:
+                relevant_month = monthly_average_spot_price.get(
+                    consumption.from_datetime.strftime('%m'), 0)
+                relevant_month_n = relevant_month['n']
+                for zone in PRICE_ZONES:
+                    monthly[zone].append(
+                        relevant_month[zone]/relevant_month_n)
+            columns['monthly'] = monthly
+
+        return columns
+
+    def price_providers(self, provider_dicts, columns):
+        # Work is split by provider, each worker sums a whole provider in the
+        # same order as the serial path does, so the result is identical
+        # down to the last bit. Results are collected in provider order.
+        # Providers are the plain dicts from provider_to_pricing_dict.
+        n = len(columns['consumption'])
+        work = len(provider_dicts) * n
+        workers = min(PRICING_WORKERS, len(provider_dicts))
+
+        if workers < 2 or work < PRICING_PARALLEL_THRESHOLD:
+            results = [price_provider(provider, columns)
+                       for provider in provider_dicts]
+        elif PRICING_POOL == 'thread':
+            results = list(get_pricing_pool().map(
+                price_provider, provider_dicts, repeat(columns)))
+        else:
+            block, layout = share_pricing_columns(columns)
+            try:
+                results = list(get_pricing_pool().map(
+                    _price_provider_in_worker, provider_dicts,
+                    repeat(block.name), repeat(layout), repeat(n)))
+            finally:
+                block.close()
+                block.unlink()
+
+        return [result for result in results if result is not None]
 
     def ingest_providers_from_json(self, file_path):
         with open(file_path, 'r') as file:
@@ -482,11 +997,48 @@ class HelperMethods:
                     'variablePricePeriod', None),
                 spot_price=provider.get('spotPrice', None),
             )
+        SR.notify()
 
 
 
 HelperMethods = HelperMethods()
 
+
+# Recomputes stale recommendation snapshots in the background, so that a new
+# spot price publication does not turn into every customer's next
+# /api/calculate call doing the expensive calculation at the same time.
+# Only one should run per deployment, so it is never started on import, see
+# the refresh-snapshots command and __main__ below.
+class SnapshotRefresher:
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self.wake = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None and self.interval > 0:
+            self.thread = threading.Thread(
+                target=self.run, name='snapshot-refresher', daemon=True)
+            self.thread.start()
+
+    def notify(self):
+        # Refresh now instead of waiting for the next interval.
+        self.wake.set()
+
+    def run(self):
+        while True:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                with self.app.app_context():
+                    HelperMethods.refresh_snapshots()
+            except Exception:
+                logging.exception("Refreshing recommendation snapshots failed")
+
+
+SR = SnapshotRefresher(app, SNAPSHOT_REFRESH_INTERVAL)
+
 # MODELS
 consumption_model = api.model('Consumption', {
     'from_datetime': fields.DateTime(),
@@ -534,7 +1086,7 @@ consumption_model_list = api.model('ConsumptionList', {
 @api.route('/api/calculate/<string:username>')
 class CalculateBestOptions(Resource):
     def get(self, username):
-        best_options = HelperMethods.calculate_best_options_for_user(
+        best_options = HelperMethods.get_best_options_for_user(
             username=username)
         print(best_options)
         return best_options, 200
@@ -558,6 +1110,22 @@ class Upload(Resource):
         return {'url': url}, 201
 
 
+@app.cli.command('refresh-snapshots')
+def refresh_snapshots_command():
+    """
+    Keep recommendation snapshots fresh, run as its own process.
+    """
+    if SR.interval > 0:
+        SR.run()
+    else:
+        with app.app_context():
+            HelperMethods.refresh_snapshots()
+
+
 if __name__ == '__main__':
     HelperMethods.ingest_providers_from_json(PROVIDER_FILE_PATH)
+    # With debug=True the reloader serves the app from a child process,
+    # only that one runs the refresher.
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        SR.start()
     app.run(debug=True)